@@ -9,7 +9,7 @@ Author: Krishna Karra, Chris Davis
 
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 
-from animate.utils.animation import transform_scenes, make_gif
+from animate.utils.animation import transform_scenes, iter_transform_scenes, make_gif
 from animate.utils.parse_inputs import (
     check_output_file,
     check_latlon_geojson,
@@ -29,6 +29,7 @@ from animate.utils.parse_inputs import (
     check_processing_level,
     check_crs,
     check_rescale,
+    check_rescale_mode,
     check_outsize,
     check_aspect_ratio,
     check_coregister,
@@ -169,6 +170,12 @@ def get_parsed_args():
         help="Min and max percentiles for use in rescaling",
         default=[2.0, 98.0],
     )
+    parser.add_argument(
+        "--rescale_mode",
+        type=str,
+        help="Rescale percentiles per frame or over the whole stack (per_frame | global)",
+        default="per_frame",
+    )
     parser.add_argument(
         "--outsize", type=int, nargs="+", help="Output GIF image size", default=None
     )
@@ -256,6 +263,7 @@ def main():
     processing_level = check_processing_level(args.processing_level)
     crs = check_crs(args.crs)
     rescale = check_rescale(args.rescale)
+    rescale_mode = check_rescale_mode(args.rescale_mode)
     outsize = check_outsize(args.outsize)
     aspect_ratio = check_aspect_ratio(args.aspect_ratio)
     coregister = check_coregister(args.coregister)
@@ -322,9 +330,16 @@ def main():
             "Applying transformations to {0} scenes...".format(len(scenes_grouped)),
         )
 
-    frames = transform_scenes(
-        img_stack, rescale, cmap, aspect_ratio, outsize, coregister
-    )
+    # ffmpeg is streamed frames as they are transformed,
+    # other programs need the whole stack up front
+    if program == "ffmpeg":
+        frames = iter_transform_scenes(
+            img_stack, rescale, cmap, aspect_ratio, outsize, coregister, rescale_mode
+        )
+    else:
+        frames = transform_scenes(
+            img_stack, rescale, cmap, aspect_ratio, outsize, coregister, rescale_mode
+        )
 
     if verbose:
         print(datetime.datetime.now(), "Creating animation from processed scenes...")
@@ -0,0 +1,38 @@
+"""
+_kernels.py
+
+Numba compiled kernels for hot per-pixel operations.
+Numba is optional; check HAVE_NUMBA before calling into this module.
+
+Author: Krishna Karra
+"""
+
+try:
+    from numba import njit
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+
+    # serial on purpose: frames are already transformed in parallel by the
+    # frame executor, and nesting numba threads inside it is not safe.
+    # nogil lets the thread executor run frames concurrently. Note that with
+    # --rescale_mode global, the whole stack is rescaled on a single thread.
+    @njit(nogil=True, fastmath=True, cache=True)
+    def _rescale_kernel(img, vmin, vmax, min_val, max_val, out):
+        """
+        Fused subtract, scale, clip & cast of a 2D (rows, cols) array into out.
+        """
+
+        scale = max_val / (vmax - vmin)
+        for i in range(img.shape[0]):
+            for j in range(img.shape[1]):
+                v = (img[i, j] - vmin) * scale
+                if v < min_val:
+                    v = min_val
+                elif v > max_val:
+                    v = max_val
+                out[i, j] = v
@@ -7,34 +7,153 @@ Author: Krishna Karra
 """
 
 # define imports
-import moviepy.editor as mpy
 import numpy as np
-from subprocess import check_output
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+from subprocess import run, CalledProcessError, Popen, PIPE, DEVNULL
 
-from animate.utils.img_proc import rescale_img, crop_img, resize_img
-from animate.utils.coregister import coregister_stack
+from animate.utils.img_proc import (
+    rescale_img,
+    crop_bounds,
+    crop_resize_img,
+    to_uint8,
+    colormap_lut,
+)
 
 
 def make_websafe(fname):
-    fname_ext = fname[-4:]
-    fname_websafe = fname.strip(fname_ext) + "_websafe" + fname_ext
+    base, ext = os.path.splitext(fname)
+    fname_websafe = "{}_websafe{}".format(base, ext)
 
-    cmd = """ffmpeg -an -i {} -vcodec libx264 -pix_fmt yuv420p 
-             -profile:v baseline -level 3 
-             -vf pad=ceil(iw/2)*2:ceil(ih/2)*2 {}""".format(
-        fname, fname_websafe
-    )
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-an",
+        "-i",
+        fname,
+        "-vcodec",
+        "libx264",
+        "-pix_fmt",
+        "yuv420p",
+        "-profile:v",
+        "baseline",
+        "-level",
+        "3",
+        "-vf",
+        "pad=ceil(iw/2)*2:ceil(ih/2)*2",
+        fname_websafe,
+    ]
 
     try:
-        check_output(cmd.split())
-    except:
-        print(cmd)
+        run(cmd, check=True, stdin=DEVNULL, stdout=DEVNULL, stderr=PIPE)
+    except CalledProcessError as e:
+        print(" ".join(cmd))
+        print(e.stderr.decode(errors="replace"))
+        raise OSError("Failed to make websafe video!")
+    except OSError:
+        print(" ".join(cmd))
         raise OSError("Failed to make websafe video!")
 
 
-def transform_scenes(img_stack, rescale, cmap, aspect_ratio, outsize, coregister):
+def _frame_executor(max_workers):
+    """
+    Return an executor for transforming frames in parallel.
+
+    Defaults to a process pool. Set the environment variable
+    DL_ANIMATE_EXECUTOR=thread to use a thread pool instead, which
+    avoids pickling frames between processes.
+    """
+
+    if os.environ.get("DL_ANIMATE_EXECUTOR", "process").lower() == "thread":
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+
+def _transform_one(img, pmin, pmax, lut, crop, outsize):
+    """
+    Transform a single scene to a Byte RGB frame
+
+    Parameters
+    ----------
+    img: np.array
+        Image as 3D NumPy array (X, Y, channels)
+    pmin: float or None
+        Minimum percentile for rescaling, None if the scene is already Byte
+    pmax: float or None
+        Maximum percentile for rescaling, None if the scene is already Byte
+    lut: np.array or None
+        (256, 3) colormap lookup table applied to grayscale scenes
+    crop: tuple or None
+        (start, end) rows to crop scene to
+    outsize: tuple or None
+        Resizes scene to this size
+
+    Returns
+    -------
+    tmp_img: np.array
+        Transformed image as NumPy array
+    """
+
+    if pmin is None:
+        tmp_img = img
+    else:
+        # convert to floating point, between 0->1
+        tmp_img = rescale_img(img, pmin=pmin, pmax=pmax)
+
+        # convert to 0->255, Byte
+        # we've already rescaled by percentile, so we're simply doing a type conversion here
+        tmp_img = to_uint8(tmp_img)
+
+    # apply colormap if grayscale, indexing the lookup table by Byte value
+    if lut is not None:
+        tmp_img = lut[tmp_img[..., 0]]
+
+    # cropping is just a view on the rows we keep
+    if crop is not None:
+        tmp_img = tmp_img[crop[0] : crop[1]]
+    if outsize is not None:
+        tmp_img = crop_resize_img(tmp_img, new_size=outsize)
+
+    return tmp_img
+
+
+def transform_scenes(
+    img_stack, rescale, cmap, aspect_ratio, outsize, coregister, rescale_mode="per_frame"
+):
+    """
+    Transform a set of scenes, returning all frames at once.
+    See iter_transform_scenes for parameters.
+
+    Returns
+    -------
+    frames: np.array
+        Transformed frames as a single 4D Byte NumPy array (index, Y, X, 3)
     """
-    Transform a set of scenes 
+
+    frames = iter_transform_scenes(
+        img_stack, rescale, cmap, aspect_ratio, outsize, coregister, rescale_mode
+    )
+
+    # every frame comes out the same shape, so write them into one buffer
+    xform_stack = np.empty((0, 0, 0, 3), dtype=np.uint8)
+    for idx, frame in enumerate(frames):
+        if idx == 0:
+            xform_stack = np.empty((len(img_stack),) + frame.shape, dtype=np.uint8)
+        xform_stack[idx] = frame
+
+    return xform_stack
+
+
+def iter_transform_scenes(
+    img_stack, rescale, cmap, aspect_ratio, outsize, coregister, rescale_mode="per_frame"
+):
+    """
+    Transform a set of scenes, yielding one frame at a time
 
     Parameters
     ----------
@@ -50,57 +169,85 @@ def transform_scenes(img_stack, rescale, cmap, aspect_ratio, outsize, coregister
         Resizes scenes to this size
     coregister: bool
         Flag to coregister image stack to eliminate pixel jitter
+    rescale_mode: str
+        Compute rescale percentiles for each frame ("per_frame"),
+        or once over the whole stack ("global")
 
-    Returns
-    -------
-    frames: list
-        List of transformed NumPy arrays
+    Yields
+    ------
+    frame: np.array
+        Transformed NumPy array, in stack order
     """
 
-    xform_stack = list()
     pmin, pmax = rescale[0], rescale[1]
 
     # coregister stack to first frame
     if coregister:
+        try:
+            from animate.utils.coregister import coregister_stack
+        except ImportError:
+            raise RuntimeError(
+                "Coregistration needs pyfftw, scipy & scikit-image, "
+                "install with `pip3 install .[coregister]`"
+            )
         img_stack, shifts = coregister_stack(img_stack)
 
-    do_crop = False
+    # with stack-wide percentiles, rescale the whole stack to Byte in one pass
+    if rescale_mode == "global":
+        img_stack = rescale_img(
+            img_stack, max_val=255, dtype=np.uint8, pmin=pmin, pmax=pmax
+        )
+        img_stack = np.ma.getdata(img_stack)
+        pmin, pmax = None, None
+
+    # crop bounds are the same for every frame, so compute them once
+    crop = None
     if aspect_ratio:
         # TODO: check that this is right:
         # pil is [width, height] but numpy is [height, width]
         new_ratio = float(aspect_ratio[1]) / float(aspect_ratio[0])
         old_ratio = img_stack.shape[1] / img_stack.shape[2]
         if old_ratio != new_ratio:
-            do_crop = True
+            crop = crop_bounds(img_stack.shape[1], aspect_ratio)
 
-    do_outsize = False
+    new_size = None
     if outsize:
         # TODO: check that this is right:
         # pil is [width, height] but numpy is [height, width]
         old_size = (img_stack.shape[2], img_stack.shape[1])
         if outsize[0] != old_size[0] or outsize[1] != old_size[1]:
-            do_outsize = True
-
-    for idx, img in enumerate(img_stack):
-        # convert to floating point, between 0->1
-        tmp_img = rescale_img(img, pmin=pmin, pmax=pmax)
+            new_size = tuple(outsize)
 
-        # apply colormap if grayscale
-        if img.shape[-1] == 1:
-            tmp_img = cmap(tmp_img.squeeze())[:, :, :-1]
+    # sample the colormap once, rather than calling it on every frame
+    lut = None
+    if img_stack.shape[-1] == 1:
+        lut = colormap_lut(cmap)
 
-        # rescale back to 0->255, Byte
-        # we've already rescaled by percentile, so we're simply doing a type conversion here
-        tmp_img = rescale_img(tmp_img, min_val=0, max_val=255, dtype=np.uint8)
-
-        if do_crop:
-            tmp_img = crop_img(tmp_img, aspect_ratio)
-        if do_outsize:
-            tmp_img = resize_img(tmp_img, outsize)
+    transform = partial(
+        _transform_one,
+        pmin=pmin,
+        pmax=pmax,
+        lut=lut,
+        crop=crop,
+        outsize=new_size,
+    )
 
-        xform_stack.append(tmp_img)
-
-    return xform_stack
+    # frames are independent, so transform them in parallel, but only keep a
+    # few frames in flight so finished frames don't pile up ahead of the consumer
+    max_workers = os.cpu_count() or 1
+    pending = deque()
+    with _frame_executor(max_workers) as executor:
+        try:
+            for img in img_stack:
+                pending.append(executor.submit(transform, img))
+                if len(pending) >= 2 * max_workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # if the consumer stops early, don't finish the frames nobody wants
+            for future in pending:
+                future.cancel()
 
 
 def make_gif(frames, fname, fps, program, websafe):
@@ -109,8 +256,8 @@ def make_gif(frames, fname, fps, program, websafe):
 
     Parameters
     ----------
-    frames: list
-        List of NumPy arrays to animate
+    frames: iterable
+        Iterable of NumPy arrays to animate
     fname: str
         Output filename (.gif/.mp4)
     fps: int
@@ -127,12 +274,113 @@ def make_gif(frames, fname, fps, program, websafe):
 
     """
 
+    if program == "ffmpeg":
+        make_gif_ffmpeg(frames, fname, fps, websafe)
+        return
+
+    try:
+        import moviepy.editor as mpy
+    except ImportError:
+        raise RuntimeError(
+            "Program {} needs moviepy, install with `pip3 install .[moviepy]`".format(
+                program
+            )
+        )
+
     # create animation
     try:
-        clip = mpy.ImageSequenceClip(frames, fps=fps)
+        clip = mpy.ImageSequenceClip(list(frames), fps=fps)
         clip.write_gif(fname, fps=fps, program=program)
     except:
         raise RuntimeError("Animation creation failed! This is not good.")
 
     if websafe:
         make_websafe(fname)
+
+
+def make_gif_ffmpeg(frames, fname, fps, websafe):
+    """
+    Write out a GIF by streaming frames to ffmpeg over a pipe.
+    Only one frame is held at a time, so frames can be any iterable.
+
+    Parameters
+    ----------
+    frames: iterable
+        Iterable of Byte RGB NumPy arrays (Y, X, 3) to animate
+    fname: str
+        Output filename (.gif/.mp4)
+    fps: int
+        Frames per second for animation
+    websafe: bool
+        Create a websafe version of animation
+
+    Raises
+    ------
+    RuntimeError
+        Fail to create animation
+    """
+
+    frames = iter(frames)
+    try:
+        first = next(frames)
+    except StopIteration:
+        raise RuntimeError("Animation creation failed! No frames to animate.")
+
+    height, width = first.shape[0], first.shape[1]
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        "{}x{}".format(width, height),
+        "-r",
+        str(fps),
+        "-i",
+        "-",
+    ]
+
+    # build the GIF palette from the stream itself, in a single pass
+    if fname.endswith(".gif"):
+        cmd += [
+            "-vf",
+            "split[s0][s1];[s0]palettegen=max_colors=256[p];[s1][p]paletteuse=dither=sierra2_4a",
+        ]
+
+    cmd.append(fname)
+
+    # log ffmpeg's stderr to a file, since an unread pipe could fill up & deadlock
+    with tempfile.TemporaryFile() as log:
+        try:
+            proc = Popen(cmd, stdin=PIPE, stderr=log)
+        except OSError:
+            raise RuntimeError("Animation creation failed! Could not start ffmpeg.")
+
+        try:
+            for frame in chain([first], frames):
+                proc.stdin.write(frame.astype(np.uint8, copy=False).tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early, its return code & log say why
+            pass
+        except BaseException:
+            # e.g. a frame failed to transform, so don't leave ffmpeg waiting on stdin
+            proc.kill()
+            raise
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = proc.wait()
+
+        if returncode != 0:
+            log.seek(0)
+            print(log.read().decode(errors="replace"))
+            raise RuntimeError("Animation creation failed! This is not good.")
+
+    if websafe:
+        make_websafe(fname)
@@ -10,13 +10,128 @@ Author: Krishna Karra
 
 """
 
+import os
+import struct
+from functools import lru_cache
+
 import numpy as np
 import pyfftw
-from skimage.feature import register_translation
+from skimage.transform import downscale_local_mean
 import scipy.ndimage.fourier as snf
 
+# reuse FFTW plans across calls, and plan for multithreaded transforms
+pyfftw.interfaces.cache.enable()
+pyfftw.interfaces.cache.set_keepalive_time(60)
+pyfftw.config.NUM_THREADS = os.cpu_count()
+
+# each stack-sized FFT runs once per CLI run, so measuring a plan costs far
+# more than it saves. Measured plans only pay off when they are persisted,
+# so they are opt-in by pointing DL_ANIMATE_FFTW_WISDOM at a wisdom file.
+WISDOM_FILE = os.environ.get("DL_ANIMATE_FFTW_WISDOM")
+pyfftw.config.PLANNER_EFFORT = "FFTW_MEASURE" if WISDOM_FILE else "FFTW_ESTIMATE"
+# wisdom is stored as plain bytes records, each prefixed by its length
+WISDOM_RECORD = ">Q"
+
+FFTW_ARGS = {
+    "threads": pyfftw.config.NUM_THREADS,
+    "planner_effort": pyfftw.config.PLANNER_EFFORT,
+}
+
+
+@lru_cache(maxsize=None)
+def _load_wisdom():
+    """
+    Import FFTW wisdom from WISDOM_FILE, if it has been saved before.
+    Runs once, on the first coregistration rather than on import.
+    """
+
+    if not (WISDOM_FILE and os.path.isfile(WISDOM_FILE)):
+        return
+
+    try:
+        with open(WISDOM_FILE, "rb") as f:
+            data = f.read()
+        # one length prefixed bytes record per precision (double, single, long double)
+        wisdom = list()
+        offset = 0
+        while offset < len(data):
+            (length,) = struct.unpack_from(WISDOM_RECORD, data, offset)
+            offset += struct.calcsize(WISDOM_RECORD)
+            if offset + length > len(data):
+                raise ValueError("Truncated FFTW wisdom record")
+            wisdom.append(data[offset : offset + length])
+            offset += length
+        pyfftw.import_wisdom(tuple(wisdom))
+    except (OSError, struct.error, TypeError, ValueError):
+        print("Could not load FFTW wisdom from {}".format(WISDOM_FILE))
+
+
+def _save_wisdom():
+    """
+    Export FFTW wisdom to WISDOM_FILE, so later runs reuse measured plans.
+    """
+
+    if WISDOM_FILE:
+        try:
+            with open(WISDOM_FILE, "wb") as f:
+                for record in pyfftw.export_wisdom():
+                    f.write(struct.pack(WISDOM_RECORD, len(record)))
+                    f.write(record)
+        except OSError:
+            print("Could not save FFTW wisdom to {}".format(WISDOM_FILE))
+
+
+def _upsampled_dft(data, upsampled_region_size, upsample_factor=1, axis_offsets=None):
+    """
+    Upsampled DFT by matrix multiplication, evaluated only over a small
+    upsampled_region_size region around axis_offsets. Adapted from
+    skimage.registration's (private) helper of the same name, so we don't
+    depend on a private module.
+    """
+
+    upsampled_region_size = [upsampled_region_size] * data.ndim
+    if axis_offsets is None:
+        axis_offsets = [0] * data.ndim
+
+    im2pi = 1j * 2 * np.pi
+    dim_properties = list(zip(data.shape, upsampled_region_size, axis_offsets))
+
+    for n_items, ups_size, ax_offset in dim_properties[::-1]:
+        kernel = (np.arange(ups_size) - ax_offset)[:, None] * np.fft.fftfreq(
+            n_items, upsample_factor
+        )
+        kernel = np.exp(-im2pi * kernel)
+        # keep the DFT in the input's precision (complex64), rather than complex128
+        kernel = kernel.astype(data.dtype, copy=False)
+        # contract the last axis, bringing the upsampled axis to the front
+        data = np.tensordot(kernel, data, axes=(1, -1))
+
+    return data
 
-def coregister_stack(stack, base_frame=0, upsample=10, dtype=np.float32, do_shift=True):
+
+def _aligned_stack(stack, dtype):
+    """
+    Return stack as a SIMD aligned array of dtype for FFTW.
+    The stack is used as is if it already is one, otherwise it is
+    cast directly into an aligned buffer (no intermediate copy).
+    """
+
+    is_plain = isinstance(stack, np.ndarray) and not np.ma.isMaskedArray(stack)
+    if (
+        is_plain
+        and stack.dtype == dtype
+        and stack.ctypes.data % pyfftw.simd_alignment == 0
+    ):
+        return stack
+
+    obj = pyfftw.empty_aligned(stack.shape, dtype=dtype)
+    np.copyto(obj, np.ma.getdata(stack), casting="unsafe")
+    return obj
+
+
+def coregister_stack(
+    stack, base_frame=0, upsample=10, dtype=np.float32, do_shift=True, downscale=4
+):
     """
     Simple phase-correlation stack coregisterer. Align your image relative
     to base_frame (default is the 0th image) by analyzing fourier transform.
@@ -40,6 +155,12 @@ def coregister_stack(stack, base_frame=0, upsample=10, dtype=np.float32, do_shif
         If True [the default], will also shift the stack based on the median
         shift of the bands.
         If False, will just return the shifts.
+    downscale : int, optional
+        Downsampling factor for a coarse registration pass. Integer shifts
+        are found on the downsampled stack, then only refined within
+        +/- downscale pixels at full resolution. Set to 1 to register at
+        full resolution only.
+        Default is 4.
 
     Returns
     -------
@@ -55,34 +176,140 @@ def coregister_stack(stack, base_frame=0, upsample=10, dtype=np.float32, do_shif
 
     num_frames, num_rows, num_columns, num_channels = stack.shape
 
+    # reuse any measured plans before planning this stack's FFTs
+    _load_wisdom()
+
     # channel shifts will be computed separately, then averaged
     shifts = np.zeros((num_frames, num_channels, 2), dtype=dtype)
 
-    # compute FFT of all frames and bands
-    obj = pyfftw.empty_aligned(stack.shape, dtype=dtype)
-    obj[:] = stack.astype(dtype)
-    fft_stack = pyfftw.interfaces.numpy_fft.fft2(obj, axes=(1, 2))
+    # compute FFT of all frames and bands, keeping single precision throughout
+    obj = _aligned_stack(stack, dtype)
+    fft_stack = pyfftw.interfaces.numpy_fft.fft2(obj, axes=(1, 2), **FFTW_ARGS)
+    fft_stack = fft_stack.astype(np.complex64, copy=False)
+
+    # coarse pass on a downsampled stack, to skip full size cross-correlations
+    coarse_fft = None
+    if downscale > 1:
+        coarse = downscale_local_mean(
+            np.ma.getdata(stack), (1, downscale, downscale, 1)
+        ).astype(dtype)
+        coarse_fft = pyfftw.interfaces.numpy_fft.fft2(
+            _aligned_stack(coarse, dtype), axes=(1, 2), **FFTW_ARGS
+        )
+        coarse_fft = coarse_fft.astype(np.complex64, copy=False)
 
     for frame in range(num_frames):
         if frame == base_frame:
             continue
-        for layer in range(num_channels):
-            shift = register_translation(
-                fft_stack[base_frame, :, :, layer],
-                fft_stack[frame, :, :, layer],
-                upsample_factor=upsample,
-                space="fourier",
-            )[0]
-            shifts[frame, layer] = shift
+
+        initial_shifts = None
+        if coarse_fft is not None:
+            initial_shifts = downscale * register_channels(
+                coarse_fft[base_frame], coarse_fft[frame], upsample=1
+            )
+
+        shifts[frame] = register_channels(
+            fft_stack[base_frame],
+            fft_stack[frame],
+            upsample=upsample,
+            initial_shifts=initial_shifts,
+            radius=downscale,
+        )
 
     if do_shift:
         # average shifts by channel
         averaged_shifts = np.median(shifts, axis=1)  # (num_frames, 2)
         # since we already have the FFT, use it to implement shift
-        return shift_stack(fft_stack, averaged_shifts, space="fourier"), averaged_shifts
+        shifted_stack = shift_stack(fft_stack, averaged_shifts, space="fourier")
+        _save_wisdom()
+        return shifted_stack, averaged_shifts
+    else:
+        _save_wisdom()
+        return shifts
+
+
+def register_channels(base_fft, frame_fft, upsample=10, initial_shifts=None, radius=4):
+    """
+    Phase-correlate every channel of a frame against a base frame at once.
+    This follows skimage's phase_cross_correlation (with normalization=None),
+    but treats channels as a batch axis so the cross-correlation is a single
+    FFT per frame.
+
+    Parameters
+    ----------
+    base_fft : numpy array (rows, cols, channels)
+        FFT of the frame to register to.
+    frame_fft : numpy array (rows, cols, channels)
+        FFT of the frame to register.
+    upsample : int, optional
+        Upsampling factor. Shifts are refined to within 1 / upsample of a
+        pixel by an upsampled DFT around each channel's peak.
+        Default is to 10.
+    initial_shifts : numpy array (channels, 2), optional
+        Integer shift estimates by channel, e.g. from a downsampled stack.
+        If given, the integer peak is only searched for within +/- radius
+        pixels of them instead of over the full cross-correlation.
+        Default is None.
+    radius : int, optional
+        Search radius in pixels around initial_shifts.
+        Default is 4.
+
+    Returns
+    -------
+    shifts : numpy array (channels, 2)
+        The measured shift by channel.
+    """
+
+    num_rows, num_columns, num_channels = frame_fft.shape
+    shape = np.array([num_rows, num_columns])
+
+    image_product = base_fft * frame_fft.conj()
+
+    if initial_shifts is not None:
+        # integer peak from a small window of the cross-correlation
+        shifts = _refine_peaks(image_product, initial_shifts, 1, 2 * radius + 1)
     else:
+        # cross-correlation of all channels in one batched inverse FFT
+        cross_correlation = pyfftw.interfaces.numpy_fft.ifft2(
+            image_product, axes=(0, 1), **FFTW_ARGS
+        )
+
+        # integer peak per channel, wrapped to negative shifts past the midpoint
+        peaks = np.abs(cross_correlation).reshape(-1, num_channels).argmax(axis=0)
+        shifts = np.stack(np.unravel_index(peaks, (num_rows, num_columns)), axis=-1)
+        shifts = shifts.astype(np.float64)
+        midpoints = np.fix(shape / 2.0)
+        shifts = np.where(shifts > midpoints, shifts - shape, shifts)
+
+    if upsample == 1:
         return shifts
 
+    # refine each peak with an upsampled DFT over a small region around it
+    shifts = np.round(shifts * upsample) / upsample
+    region_size = int(np.ceil(upsample * 1.5))
+
+    return _refine_peaks(image_product, shifts, upsample, region_size)
+
+
+def _refine_peaks(image_product, shifts, upsample, region_size):
+    """
+    Find the cross-correlation peak of each channel within a region_size
+    window (in 1 / upsample pixel steps) centered on the given shifts,
+    using a matrix-multiply DFT rather than a full inverse FFT.
+    """
+
+    shifts = np.array(shifts, dtype=np.float64)
+    dftshift = np.fix(region_size / 2.0)
+    for layer in range(image_product.shape[-1]):
+        offsets = dftshift - shifts[layer] * upsample
+        region = _upsampled_dft(
+            image_product[:, :, layer].conj(), region_size, upsample, offsets
+        ).conj()
+        maxima = np.unravel_index(np.argmax(np.abs(region)), region.shape)
+        shifts[layer] += (np.array(maxima, dtype=np.float64) - dftshift) / upsample
+
+    return shifts
+
 
 def shift_stack(stack, shifts, space="real", dtype=np.float32):
     """
@@ -112,23 +339,28 @@ def shift_stack(stack, shifts, space="real", dtype=np.float32):
 
     # compute FFT of all frames and bands
     if space.lower() == "real":
-        obj = pyfftw.empty_aligned(stack.shape, dtype=dtype)
-        obj[:] = stack.astype(dtype)
-        fft_stack = pyfftw.interfaces.numpy_fft.fft2(obj, axes=(1, 2))
+        obj = _aligned_stack(stack, dtype)
+        fft_stack = pyfftw.interfaces.numpy_fft.fft2(obj, axes=(1, 2), **FFTW_ARGS)
     # unless we already did that
     elif space.lower() == "fourier":
         fft_stack = stack
     else:
         raise ValueError("Unrecognized shift space {0}".format(space))
 
-    shifted_stack = np.empty_like(fft_stack, dtype=dtype)
+    # applying the shift is a cheap phase ramp per frame & channel
+    shifted_fft = np.empty_like(fft_stack)
     for frame in range(num_frames):
         shift = shifts[frame]
         for layer in range(num_channels):
-            shifted_stack[frame, :, :, layer] = np.real(
-                pyfftw.interfaces.numpy_fft.ifft2(
-                    snf.fourier_shift(fft_stack[frame, :, :, layer], shift)
-                )
+            snf.fourier_shift(
+                fft_stack[frame, :, :, layer],
+                shift,
+                output=shifted_fft[frame, :, :, layer],
             )
 
+    # then invert the whole stack in one batched FFT
+    shifted_stack = np.real(
+        pyfftw.interfaces.numpy_fft.ifft2(shifted_fft, axes=(1, 2), **FFTW_ARGS)
+    ).astype(dtype, copy=False)
+
     return shifted_stack
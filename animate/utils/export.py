@@ -6,8 +6,6 @@ Functions to export information to file.
 Author: Krishna Karra
 """
 
-import descarteslabs as dl
-
 import json
 from pprint import pformat
 
@@ -30,6 +28,7 @@ def export_summary(ids_group, dltile, outfile):
     RuntimeError
         If export to summary fails
     """
+    import descarteslabs as dl
 
     try:
         with open(outfile, "w") as f:
@@ -43,12 +42,16 @@ def export_summary(ids_group, dltile, outfile):
             f.write(
                 "There are {} scene groups in this animation\n\n".format(len(ids_group))
             )
+            # the same scene can show up in several groups, only fetch it once
+            meta_cache = dict()
             for idx, id_group in enumerate(ids_group):
                 f.write(
                     "---ID Group {}, with {} scenes---\n".format(idx, len(id_group))
                 )
                 for this_id in id_group:
-                    meta = dl.metadata.get(this_id)
+                    if this_id not in meta_cache:
+                        meta_cache[this_id] = dl.metadata.get(this_id)
+                    meta = meta_cache[this_id]
                     meta_pretty = pformat(meta, indent=4, compact=True)
                     f.write(meta_pretty)
                     f.write("\n\n")
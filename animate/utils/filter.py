@@ -6,7 +6,8 @@ Useful filtering operations.
 Author: Krishna Karra, Chris Davis
 """
 
-import descarteslabs as dl
+import operator
+from functools import reduce
 
 
 def build_filters(fill_fraction, sat_id, solar_az_angle, solar_el_angle):
@@ -29,34 +30,32 @@ def build_filters(fill_fraction, sat_id, solar_az_angle, solar_el_angle):
     filters: list
         List of filtering expressions that can be evaluated
     """
+    import descarteslabs as dl
 
     filters = list()
     if fill_fraction:
-        filters.append(dl.properties.fill_fraction >= "{}".format(fill_fraction))
+        filters.append(dl.properties.fill_fraction >= fill_fraction)
 
     if sat_id:
-        filters.append(dl.properties.sat_id == "{}".format(sat_id))
+        filters.append(dl.properties.sat_id == sat_id)
 
     if solar_az_angle:
         filters.append(
-            "{}".format(solar_az_angle[0])
+            solar_az_angle[0]
             <= dl.properties.solar_azimuth_angle
-            <= "{}".format(solar_az_angle[1])
+            <= solar_az_angle[1]
         )
 
     if solar_el_angle:
         filters.append(
-            "{}".format(solar_el_angle[0])
+            solar_el_angle[0]
             <= dl.properties.solar_elevation_angle
-            <= "{}".format(solar_el_angle[1])
+            <= solar_el_angle[1]
         )
 
     if not filters:
         filters = None
     else:
-        f = filters[0]
-        for fi in filters[1:]:
-            f = f & fi
-        filters = f
+        filters = reduce(operator.and_, filters)
 
     return filters
@@ -6,9 +6,33 @@ Image processing functions for transforming a stack of imagery.
 Author: Krishna Karra
 """
 
+from functools import lru_cache
+
 import numpy as np
 from PIL import Image
 
+# images with more pixels than this have their percentiles estimated
+# from a strided sample, rather than from every pixel
+SAMPLE_THRESHOLD = 1000000
+SAMPLE_STRIDE = 4
+
+
+@lru_cache(maxsize=None)
+def _load_rescale_kernel():
+    """
+    Import the numba rescale kernel on first use, so importing animate
+    doesn't pay for numba. Returns None if numba isn't installed.
+    """
+
+    from animate.utils._kernels import HAVE_NUMBA
+
+    if not HAVE_NUMBA:
+        return None
+
+    from animate.utils._kernels import _rescale_kernel
+
+    return _rescale_kernel
+
 
 def resize_img(img, new_size):
     """
@@ -53,20 +77,85 @@ def crop_img(img, aspect_ratio):
         Cropped image as NumPy array
     """
 
+    start, end = crop_bounds(img.shape[0], aspect_ratio)
+
+    img_crop = img[start:end, :, :]
+    return img_crop
+
+
+def crop_bounds(height, aspect_ratio):
+    """
+    Compute the rows to keep when cropping to a new aspect ratio.
+
+    Parameters
+    ----------
+    height: int
+        Height of the image in pixels
+    aspect_ratio: list
+        Aspect ratio [width, height] to crop to
+
+    Returns
+    -------
+    start, end: int
+        Start and end rows of the crop
+    """
+
     ratio = float(aspect_ratio[1]) / float(aspect_ratio[0])
 
     # compute start and end pixels for height
-    old_height = img.shape[0]
-    new_height = old_height * ratio
+    new_height = height * ratio
 
-    start = round((old_height - new_height) / 2.0)
+    start = round((height - new_height) / 2.0)
     end = round(start + new_height)
 
-    img_crop = img[start:end, :, :]
-    return img_crop
+    return start, end
 
 
-def rescale_img(img, min_val=0.0, max_val=1.0, dtype=np.float32, pmin=0.0, pmax=100.0):
+def crop_resize_img(img, aspect_ratio=None, new_size=None):
+    """
+    Crop an image to a new aspect ratio and/or resize it in a single
+    PIL round-trip.
+
+    Parameters
+    ----------
+    img: np.array
+        Image as NumPy array
+    aspect_ratio: list
+        Aspect ratio [width, height] to crop to (default None, no crop)
+    new_size: tuple or list
+        Desired output size (default None, no resize)
+
+    Returns
+    -------
+    img_out: np.array
+        Cropped and resized image as NumPy array
+    """
+
+    img_pil = Image.fromarray(img.squeeze())
+
+    if aspect_ratio:
+        start, end = crop_bounds(img.shape[0], aspect_ratio)
+        img_pil = img_pil.crop((0, start, img_pil.width, end))
+    if new_size:
+        img_pil = img_pil.resize(size=tuple(new_size), resample=Image.LANCZOS)
+
+    img_out = np.asarray(img_pil)
+
+    if len(img_out.shape) == 2:
+        img_out = img_out[..., np.newaxis]
+
+    return img_out
+
+
+def rescale_img(
+    img,
+    min_val=0.0,
+    max_val=1.0,
+    dtype=np.float32,
+    pmin=0.0,
+    pmax=100.0,
+    sample_stride=None,
+):
     """
     Return a scaled image between [0, 255] regardless of input scaling.
 
@@ -84,19 +173,102 @@ def rescale_img(img, min_val=0.0, max_val=1.0, dtype=np.float32, pmin=0.0, pmax=
         Minimum percentage of values for scaling (default 0%)
     pmax : float
         Maximum percentage of values for scaling (default 100%)
+    sample_stride : int
+        Estimate percentiles from every Nth row & column (default None,
+        which uses SAMPLE_STRIDE for images larger than SAMPLE_THRESHOLD
+        pixels, and every pixel otherwise)
 
     Returns
     -------
     img_rescale: np.array
-        Image as NumPy array
+        Image as NumPy array, filled with min_val if the image is flat
 
     """
 
     # compute min and max percentile ranges to scale with
-    vmin, vmax = np.nanpercentile(img, pmin), np.nanpercentile(img, pmax)
+    # a full range is just min/max, which avoids the partition in nanpercentile
+    if pmin == 0.0 and pmax == 100.0:
+        vmin, vmax = np.nanmin(img), np.nanmax(img)
+    else:
+        if sample_stride is None:
+            sample_stride = SAMPLE_STRIDE if img.size > SAMPLE_THRESHOLD else 1
+        # strided view over rows & columns, so sampling doesn't copy
+        if img.ndim > 3:
+            sample = img[..., ::sample_stride, ::sample_stride, :]
+        else:
+            sample = img[::sample_stride, ::sample_stride]
+        vmin, vmax = np.nanpercentile(sample, [pmin, pmax])
 
-    # rescale & clip
-    img_rescale = ((img - vmin) * (1.0 / (vmax - vmin) * max_val)).astype(dtype)
+    # a flat image (e.g. an all fill scene) has no range to stretch,
+    # so it maps to min_val rather than dividing by zero
+    if vmax == vmin:
+        img_rescale = np.full(img.shape, min_val, dtype=dtype)
+        if np.ma.isMaskedArray(img):
+            img_rescale = np.ma.masked_array(
+                img_rescale, mask=np.ma.getmaskarray(img)
+            )
+        return img_rescale
+
+    # rescale & clip in a single fused pass if we can
+    # masked arrays carry their mask along, so those use the NumPy path
+    rescale_kernel = _load_rescale_kernel()
+    if rescale_kernel is not None and not np.ma.isMaskedArray(img) and img.ndim > 1:
+        img_rescale = np.empty(img.shape, dtype=dtype)
+        rescale_kernel(
+            img.reshape(img.shape[0], -1),
+            float(vmin),
+            float(vmax),
+            float(min_val),
+            float(max_val),
+            img_rescale.reshape(img.shape[0], -1),
+        )
+        return img_rescale
+
+    # stay in float32, percentiles come back as float64 and would promote the image
+    vmin, vmax = np.float32(vmin), np.float32(vmax)
+    scale = np.float32(max_val / (vmax - vmin))
+
+    img_rescale = np.subtract(img, vmin, dtype=np.float32)
+    np.multiply(img_rescale, scale, out=img_rescale)
     np.clip(img_rescale, min_val, max_val, out=img_rescale)
 
-    return img_rescale
+    return img_rescale.astype(dtype, copy=False)
+
+
+def to_uint8(img):
+    """
+    Convert an image already scaled between [0, 1] to Byte.
+
+    Parameters
+    ----------
+    img: np.array
+        Image as NumPy array, scaled between [0, 1]
+
+    Returns
+    -------
+    img_byte: np.array
+        Image as NumPy array of type np.uint8
+    """
+
+    img_byte = np.multiply(img, 255.0, out=np.empty(img.shape, dtype=np.float32))
+    np.clip(img_byte, 0, 255, out=img_byte)
+
+    return img_byte.astype(np.uint8, copy=False)
+
+
+def colormap_lut(cmap):
+    """
+    Sample a colormap into a Byte lookup table.
+
+    Parameters
+    ----------
+    cmap: matplotlib.colors.Colormap
+        Colormap object that transforms a numpy array
+
+    Returns
+    -------
+    lut: np.array
+        (256, 3) RGB lookup table of type np.uint8, indexed by Byte value
+    """
+
+    return (cmap(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
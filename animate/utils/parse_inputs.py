@@ -2,22 +2,36 @@
 parse_inputs.py
 
 Parse command line inputs, and return useful parameters.
+The platform client and matplotlib are only imported by the checks that need them.
 """
 
 # define imports
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 import os
-import json
 from warnings import warn
 
-from matplotlib import pyplot as plt
-import descarteslabs as dl
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+except ImportError:
+    import json
+
+    _json_loads = json.loads
+
+# valid options for the choice parameters
+_SORT_ORDERS = frozenset(("asc", "desc"))
+_FLATTEN_FIELDS = ("year", "month", "day", "hour", "minute", "second")
+_FLATTEN_INDEX = {field: idx for idx, field in enumerate(_FLATTEN_FIELDS)}
+_PROC_LEVELS = frozenset(("toa", "surface"))
+_RESCALE_MODES = frozenset(("per_frame", "global"))
+_PROGRAMS = frozenset(("imageio", "ImageMagick", "ffmpeg"))
 
 
 def check_output_file(output_file):
-    try:
-        assert output_file.endswith(".gif") or output_file.endswith(".mp4")
-    except:
+    if not output_file.endswith((".gif", ".mp4")):
         raise ValueError("Output file must end in .gif or .mp4")
 
     return output_file
@@ -29,9 +43,7 @@ def check_latlon_geojson(latlon, geojson, resolution, tilesize, pad):
         check1 = resolution is not None
         check2 = (tilesize is not None) & (pad is not None)
 
-        try:
-            assert (check1 or check2) and not (check1 and check2)
-        except:
+        if not ((check1 or check2) and not (check1 and check2)):
             raise ValueError(
                 "For geojson, either resolution OR tilesize & pad must be specified!"
             )
@@ -41,10 +53,13 @@ def check_latlon_geojson(latlon, geojson, resolution, tilesize, pad):
                 geojson, latlon[0], latlon[1]
             )
         )
-        if geojson.endswith('json') or geojson.endswith('geojson'):
-            with open(geojson, "r") as f:
-                geojson_dict = json.load(f)
+        # covers both .json and .geojson
+        if geojson.endswith("json"):
+            with open(geojson, "rb") as f:
+                geojson_dict = _json_loads(f.read())
         else:
+            import descarteslabs as dl
+
             geojson_dict = dl.places.shape(geojson)
 
         if "features" in geojson_dict:
@@ -62,94 +77,136 @@ def check_latlon_geojson(latlon, geojson, resolution, tilesize, pad):
         latlon = None
     else:
         check = (resolution is not None) & (tilesize is not None) & (pad is not None)
-        assert check
+        if not check:
+            raise ValueError(
+                "For lat/lon, resolution, tilesize & pad must all be specified!"
+            )
 
     if geojson is None and (latlon is None):
         raise ValueError("Need to either specify a geojson shape or else a lat and lon")
     return latlon, geojson
 
 
+@lru_cache(maxsize=None)
+def _cached_bands(product):
+    import descarteslabs as dl
+
+    return dl.metadata.bands(product)
+
+
+@lru_cache(maxsize=None)
+def _cached_derived_bands():
+    import descarteslabs as dl
+
+    return dl.metadata.derived_bands()
+
+
+def _fetch_product_bands(product):
+    # returns whether the product exists, and its band names (None on failure)
+    import descarteslabs as dl
+
+    try:
+        _ = dl.metadata.get_product(product)
+    except Exception:
+        return False, None
+
+    try:
+        return True, [b["name"] for b in _cached_bands(product)]
+    except Exception:
+        return True, None
+
+
 def check_products_bands_scales(products, bands, scales):
-    for product in products:
-        try:
-            _ = dl.metadata.get_product(product)
-        except:
-            raise ValueError("Product {} not found!".format(product))
+    bands_set = set(bands)
 
-        try:
-            product_bands_list = dl.metadata.bands(product)
-            drv_bands_list = dl.metadata.derived_bands()
+    # derived bands are the same for every product
+    try:
+        drv_bands = [b["name"] for b in _cached_derived_bands()]
+    except Exception:
+        raise ValueError("Bands {} are not valid!".format(bands))
 
-            product_bands = [b["name"] for b in product_bands_list]
-            drv_bands = [b["name"] for b in drv_bands_list]
+    # look up all products at once, then validate them in order
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(products)))) as executor:
+        product_info = list(executor.map(_fetch_product_bands, products))
 
-            avail_bands = product_bands + drv_bands
+    for product, (found, product_bands) in zip(products, product_info):
+        if not found:
+            raise ValueError("Product {} not found!".format(product))
 
-            assert set(bands).issubset(set(avail_bands))
+        if product_bands is None:
+            raise ValueError("Bands {} are not valid!".format(bands))
 
-            bands_gif = list()
-            bands_exp = list()
-            for bidx, b in enumerate(bands):
-                bands_exp.append(b)
-                if bidx < 3 or b == "alpha":
-                    bands_gif.append(b)
+        avail_bands = product_bands + drv_bands
 
-        except:
+        if not bands_set.issubset(set(avail_bands)):
             raise ValueError("Bands {} are not valid!".format(bands))
 
-    try:
-        if scales:
-            assert len(scales) == 2 * len(bands)
-            scales_format = list()
-            for sidx in range(0, len(scales), 2):
-                scales_format.append((scales[sidx], scales[sidx + 1]))
-        else:
-            scales_format = None
-    except:
-        raise ValueError(
-            "Scales {} are invalid, you must specify per band".format(scales)
-        )
+    bands_gif = list()
+    bands_exp = list()
+    for bidx, b in enumerate(bands):
+        bands_exp.append(b)
+        if bidx < 3 or b == "alpha":
+            bands_gif.append(b)
+
+    if scales:
+        if len(scales) != 2 * len(bands):
+            raise ValueError(
+                "Scales {} are invalid, you must specify per band".format(scales)
+            )
+        scales_format = list()
+        for sidx in range(0, len(scales), 2):
+            scales_format.append((scales[sidx], scales[sidx + 1]))
+    else:
+        scales_format = None
 
     return products, bands_gif, bands_exp, scales_format
 
 
+def _parse_datetime(dt):
+    # our two formats are fixed width, so slice them directly
+    # (only when every field is plain digits, int() would accept e.g. "+1" or " 1")
+    if len(dt) == 10 and dt[4] == dt[7] == "-":
+        fields = (dt[:4], dt[5:7], dt[8:10])
+        if all(field.isdigit() for field in fields):
+            return datetime(*map(int, fields))
+    if (
+        len(dt) == 19
+        and dt[4] == dt[7] == "-"
+        and dt[10] == "T"
+        and dt[13] == dt[16] == ":"
+    ):
+        fields = (dt[:4], dt[5:7], dt[8:10], dt[11:13], dt[14:16], dt[17:19])
+        if all(field.isdigit() for field in fields):
+            return datetime(*map(int, fields))
+
+    # anything else (e.g. unpadded months) must still be one of our two formats
+    if "T" in dt:
+        return datetime.strptime(dt, "%Y-%m-%dT%H:%M:%S")
+    return datetime.strptime(dt, "%Y-%m-%d")
+
+
 def check_datetimes(start_datetime, end_datetime):
     try:
-        if "T" in start_datetime:
-            start = datetime.strptime(start_datetime, "%Y-%m-%dT%H:%M:%S")
-        else:
-            start = datetime.strptime(start_datetime, "%Y-%m-%d")
-
-        if "T" in end_datetime:
-            end = datetime.strptime(end_datetime, "%Y-%m-%dT%H:%M:%S")
-        else:
-            end = datetime.strptime(end_datetime, "%Y-%m-%d")
+        start = _parse_datetime(start_datetime)
+        end = _parse_datetime(end_datetime)
 
-    except:
+    except ValueError:
         raise ValueError(
             "Failed to parse {} and {} datetimes!".format(start_datetime, end_datetime)
         )
 
-    return start, end
+    # the platform search takes strings, so hand back normalized ISO strings
+    return start.isoformat(timespec="seconds"), end.isoformat(timespec="seconds")
 
 
 def check_tile_parameters(resolution, tilesize, pad):
-    try:
-        if resolution is not None:
-            assert resolution > 0.0
-    except:
+    if resolution is not None and not resolution > 0.0:
         raise ValueError("Resolution {} is invalid!".format(resolution))
 
-    try:
-        if tilesize is not None:
-            assert tilesize > 0
-    except:
+    if tilesize is not None and not tilesize > 0:
         raise ValueError("Tilesize {} is invalid!".format(tilesize))
 
-    try:
-        if pad is not None:
-            assert pad >= 0
-    except:
+    if pad is not None and not pad >= 0:
         raise ValueError("Pad {} is invalid!".format(pad))
 
     return resolution, tilesize, pad
@@ -157,9 +214,7 @@ def check_tile_parameters(resolution, tilesize, pad):
 
 def check_cloud_fraction(cloud_fraction):
     if cloud_fraction:
-        try:
-            assert cloud_fraction <= 1.0 and cloud_fraction >= 0.0
-        except:
+        if not 0.0 <= cloud_fraction <= 1.0:
             raise ValueError("Cloud fraction {} is invalid!".format(cloud_fraction))
 
     return cloud_fraction
@@ -167,34 +222,26 @@ def check_cloud_fraction(cloud_fraction):
 
 def check_fill_fraction(fill_fraction):
     if fill_fraction:
-        try:
-            assert 0.0 <= fill_fraction <= 1.0
-        except:
+        if not 0.0 <= fill_fraction <= 1.0:
             raise ValueError("Fill fraction {} is invalid!".format(fill_fraction))
 
     return fill_fraction
 
 
 def check_valid_fraction(valid_fraction, bands):
-    try:
-        assert valid_fraction is None or (
-            valid_fraction <= 1.0 and valid_fraction >= 0.0
-        )
-        #if valid_fraction:
-        #    if "alpha" not in bands:
-        #        raise ValueError(
-        #            "An alpha band must be provided if valid fraction is provided!"
-        #        )
-    except:
+    if valid_fraction is not None and not 0.0 <= valid_fraction <= 1.0:
         raise ValueError("Valid fraction {} is invalid!".format(valid_fraction))
+    #if valid_fraction:
+    #    if "alpha" not in bands:
+    #        raise ValueError(
+    #            "An alpha band must be provided if valid fraction is provided!"
+    #        )
 
     return valid_fraction
 
 
 def check_raster_len(raster_len):
-    try:
-        assert 0 <= raster_len <= 500
-    except:
+    if not 0 <= raster_len <= 500:
         raise ValueError(
             "Number of scenes to rasterize at a time must be between 0 and 500!"
         )
@@ -208,15 +255,10 @@ def check_sat_id(sat_id):
 
 def check_solar_az_angle(solar_az_angle):
     if solar_az_angle:
-        try:
-            assert len(solar_az_angle) == 2
-        except:
+        if len(solar_az_angle) != 2:
             raise ValueError("Solar azimuth angle must be length 2, [min, max]!")
 
-        try:
-            for a in solar_az_angle:
-                assert 0.0 <= a <= 360.0
-        except:
+        if not all(0.0 <= a <= 360.0 for a in solar_az_angle):
             raise ValueError("Solar azimuth angles must be between 0 and 360 deg!")
 
     return solar_az_angle
@@ -224,15 +266,10 @@ def check_solar_az_angle(solar_az_angle):
 
 def check_solar_el_angle(solar_el_angle):
     if solar_el_angle:
-        try:
-            assert len(solar_el_angle) == 2
-        except:
+        if len(solar_el_angle) != 2:
             raise ValueError("Solar elevation angle must be length 2, [min, max]!")
 
-        try:
-            for a in solar_el_angle:
-                assert 0.0 <= a <= 360.0
-        except:
+        if not all(0.0 <= a <= 360.0 for a in solar_el_angle):
             raise ValueError("Solar elevation angles must be between 0 and 360 deg!")
 
     return solar_el_angle
@@ -243,86 +280,69 @@ def check_sort_field(sort_field):
 
 
 def check_sort_order(sort_order):
-    try:
-        options = ["asc", "desc"]
-        assert sort_order in options
-
-    except:
+    if sort_order not in _SORT_ORDERS:
         raise ValueError('Sort order must be either "asc" or "desc"!')
 
     return sort_order
 
 
 def check_flatten(flatten):
-    try:
-        options = ["year", "month", "day", "hour", "minute", "second"]
-        if flatten:
-            assert flatten in options
-        
-            # need the properties.date
-            flatten = [
-            "properties.date." + i for i in options[: options.index(flatten) + 1]
-            ]
-
-    except:
-        raise ValueError("Flatten {} is an invalid option!".format(flatten))
+    if flatten:
+        if flatten not in _FLATTEN_INDEX:
+            raise ValueError("Flatten {} is an invalid option!".format(flatten))
+
+        # need the properties.date
+        flatten = [
+            "properties.date." + i
+            for i in _FLATTEN_FIELDS[: _FLATTEN_INDEX[flatten] + 1]
+        ]
 
     return flatten
 
 
 def check_processing_level(processing_level):
-    try:
-        options = ["toa", "surface"]
-        if processing_level:
-            assert processing_level in options
-
-    except:
+    if processing_level and processing_level not in _PROC_LEVELS:
         raise ValueError("Processing level {} is an invalid option!".format(processing_level))
 
     return processing_level
 
 
 def check_crs(crs):
-    try:
-        if crs:
-            epsg_check = 'EPSG' in crs
-            proj_check = 'proj' in crs
-            assert(epsg_check or proj_check)
-    except:
-        raise ValueError('CRS {} must be an EPSG code or a proj4 string'.format(crs))
+    if crs:
+        epsg_check = 'EPSG' in crs
+        proj_check = 'proj' in crs
+        if not (epsg_check or proj_check):
+            raise ValueError('CRS {} must be an EPSG code or a proj4 string'.format(crs))
 
     return crs
 
 
 def check_rescale(rescale):
-    try:
-        assert len(rescale) == 2
-    except:
+    if len(rescale) != 2:
         raise ValueError("Rescale must be length 2, [pmin, pmax]")
 
-    try:
-        for r in rescale:
-            assert 0.0 <= r <= 100.0
-    except:
+    if not all(0.0 <= r <= 100.0 for r in rescale):
         raise ValueError("pmin and pmax must be between 0 and 100 (percentile)")
 
     return rescale
 
 
+def check_rescale_mode(rescale_mode):
+    if rescale_mode not in _RESCALE_MODES:
+        raise ValueError("Rescale mode {} is an invalid option!".format(rescale_mode))
+
+    return rescale_mode
+
+
 def check_outsize(outsize):
-    try:
-        assert outsize is None or len(outsize) == 2
-    except:
+    if outsize is not None and len(outsize) != 2:
         raise ValueError("Outsize must be a tuple or list of length 2 (X, Y)")
 
     return outsize
 
 
 def check_aspect_ratio(aspect_ratio):
-    try:
-        if aspect_ratio:
-            assert len(aspect_ratio) == 2
-    except:
+    if aspect_ratio and len(aspect_ratio) != 2:
         raise ValueError("Aspect ratio {} is an invalid option!".format(aspect_ratio))
 
     return aspect_ratio
@@ -342,35 +362,37 @@ def check_outdir(outdir):
         else:
             # grab home directory
             outdir = os.path.expanduser("~")
-    except:
+    except OSError:
         raise ValueError("Could not create output directory {}".format(outdir))
 
     return outdir
 
 
+@lru_cache(maxsize=32)
+def _get_cmap(name):
+    from matplotlib import pyplot as plt
+
+    return plt.get_cmap(name)
+
+
 def check_colormap(cmap):
     try:
-        cm = plt.get_cmap(cmap)
-    except:
+        cm = _get_cmap(cmap)
+    except (ValueError, KeyError):
         raise ValueError("Could not retrieve colormap {}".format(cmap))
 
     return cm
 
 
 def check_fps(fps):
-    try:
-        assert fps > 0 and fps <= 30
-    except:
+    if not 0 < fps <= 30:
         raise ValueError("Frames per second for GIF/MP4 must be between 0 and 30")
 
     return fps
 
 
 def check_program(program):
-    try:
-        options = ["imageio", "ImageMagick", "ffmpeg"]
-        assert program in options
-    except:
+    if program not in _PROGRAMS:
         raise ValueError("Program {} for GIF/MP4 creation is invalid".format(program))
 
     return program
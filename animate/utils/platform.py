@@ -6,13 +6,15 @@ Handy functions that wrap the Descartes Labs platform.
 Author: Krishna Karra
 """
 
-import descarteslabs as dl
 import numpy as np
 import datetime
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 
-from descarteslabs.scenes.scene import Scene
-from descarteslabs.scenes.scenecollection import SceneCollection
+
+# maximum number of concurrent raster/download calls to the platform
+MAX_WORKERS = 8
 
 
 def determine_geocontext(latlon, resolution, tilesize, pad, geojson, crs, verbose):
@@ -38,12 +40,14 @@ def determine_geocontext(latlon, resolution, tilesize, pad, geojson, crs, verbos
     -------
     Fully specified geocontext object
     """
+    import descarteslabs as dl
+
     if geojson:
         if resolution is not None:
             ctx = dl.scenes.geocontext.AOI(geometry=geojson, resolution=resolution, crs=crs)
         else:
             shape = tilesize + 2 * pad
-            ctx = dl.scenes.geocontext.AOI(geometry=geojson, shape=(shape, shape), crs=-crs)
+            ctx = dl.scenes.geocontext.AOI(geometry=geojson, shape=(shape, shape), crs=crs)
     else:
         tile = dl.scenes.geocontext.DLTile.from_latlon(
             lat=latlon[0], lon=latlon[1], resolution=resolution, tilesize=tilesize, pad=pad
@@ -79,10 +83,10 @@ def find_scenes(
         Could be either an AOI or a DLTile
     product: list of strings
         List of product IDs on Descartes Labs platform
-    start_datetime: datetime.datetime object
-        Start datetime
-    end_datetime: datetime.datetime object
-        End datetime
+    start_datetime: str
+        Start datetime as an ISO string (YYYY-MM-DDTHH:MM:SS)
+    end_datetime: str
+        End datetime as an ISO string (YYYY-MM-DDTHH:MM:SS)
     cloud_fraction: float
         Cloud fraction to filter scenes by
         This is handled separately from other filtering expressions
@@ -100,14 +104,14 @@ def find_scenes(
     scenes: SceneCollections
     """
 
+    import descarteslabs as dl
+
     # search for metadata IDs
-    sd = start_datetime.strftime("%Y-%m-%dT%H:%M:%S")
-    ed = end_datetime.strftime("%Y-%m-%dT%H:%M:%S")
     scenes, ctx = dl.scenes.search(
         aoi=ctx,
         products=products,
-        start_datetime=sd,
-        end_datetime=ed,
+        start_datetime=start_datetime,
+        end_datetime=end_datetime,
         query=filters,
         sort_field=sort_field,
         sort_order=sort_order,
@@ -126,7 +130,11 @@ def slow_mosaic(scenes, bands, raster_len=1, bands_axis=-1, **kwargs):
     """Given a set of scenes, locally mosaic"""
     if bands_axis != -1:
         raise ValueError("expect bands_axis to be -1, got {0}".format(bands_axis))
+    # the first chunk becomes the output buffer, later chunks are merged into it
+    # in place, using a scratch buffer for the valid pixel mask
     mosaic = None
+    valid = None
+    alpha_idx = bands.index("alpha") if "alpha" in bands else -1
     for sidx in range(0, len(scenes), raster_len):
         eidx = sidx + raster_len
         mosaic_i = scenes[sidx:eidx].mosaic(
@@ -137,22 +145,57 @@ def slow_mosaic(scenes, bands, raster_len=1, bands_axis=-1, **kwargs):
         else:
             # if we have a mask, use that
             if np.ma.is_masked(mosaic_i):
-                mosaic[~mosaic_i.mask] = mosaic_i[~mosaic_i.mask]
+                if valid is None:
+                    valid = np.empty(mosaic_i.shape, dtype=bool)
+                np.logical_not(mosaic_i.mask, out=valid)
+                np.copyto(
+                    np.ma.getdata(mosaic), np.ma.getdata(mosaic_i), where=valid
+                )
                 # if old or new mosaic pixel is unmasked
                 # then resultant pixel is also unmasked:
-                mosaic.mask = mosaic.mask * mosaic_i.mask
-            elif "alpha" in bands:
-                mask_indx = bands.index("alpha")
-                mask = mosaic_i[..., mask_indx]
-                for b in range(len(bands)):
-                    mosaic[..., b][mask] = mosaic_i[..., b][mask]
+                mosaic.mask &= mosaic_i.mask
+            elif alpha_idx >= 0:
+                mask = np.ma.getdata(mosaic_i[..., alpha_idx]).astype(bool)
+                np.copyto(
+                    np.ma.getdata(mosaic),
+                    np.ma.getdata(mosaic_i),
+                    where=mask[..., np.newaxis],
+                )
             else:
-                for b in range(len(bands)):
-                    mosaic[:, :, b] = mosaic_i[:, :, b]
+                mosaic[...] = mosaic_i
+
+        # release this chunk before rasterizing the next one
+        del mosaic_i
 
     return mosaic
 
 
+def _fill_stack(chunks, num_frames, want_mask):
+    """
+    Write chunks of frames (frames, X, Y, channels) into a single
+    preallocated stack of num_frames, sized from the first chunk.
+    Avoids building a list of arrays and copying it into a stack.
+    """
+    data, mask = None, None
+    sidx = 0
+    for chunk in chunks:
+        eidx = sidx + len(chunk)
+        if data is None:
+            data = np.empty((num_frames,) + chunk.shape[1:], dtype=chunk.dtype)
+            if want_mask:
+                mask = np.zeros(data.shape, dtype=bool)
+
+        data[sidx:eidx] = np.ma.getdata(chunk)
+        if want_mask:
+            mask[sidx:eidx] = np.ma.getmaskarray(chunk)
+        sidx = eidx
+
+    if want_mask:
+        return np.ma.array(data, mask=mask, copy=False)
+
+    return data
+
+
 def query_scenes(
     scenes,
     ctx,
@@ -213,28 +256,47 @@ def query_scenes(
     else:
         data_type = "UInt16"
 
+    # only keep masked arrays if something uses the mask, plain
+    # ndarrays are much faster through all of the later processing
+    want_mask = ("alpha" in bands) or bool(valid_fraction)
+
+    # group scenes once, the groups are used both for rastering and returned
+    if flatten:
+        scenes_grouped = [ss for key, ss in scenes.groupby(*flatten)]
+    else:
+        scenes_grouped = list(scenes)
+
     # stack
     if raster_len:
-        img_stack = []
         if flatten:
-            # mosaic each flattened step
-            for key, ss in scenes.groupby(*flatten):
-                img_stack_i = slow_mosaic(
-                    ss,
-                    raster_len=raster_len,
-                    bands=bands,
-                    ctx=ctx,
-                    scaling=scales,
-                    bands_axis=-1,
-                    processing_level=processing_level,
-                    data_type=data_type,
+            # mosaic each flattened step, several groups at a time
+            mosaic = partial(
+                slow_mosaic,
+                raster_len=raster_len,
+                bands=bands,
+                ctx=ctx,
+                scaling=scales,
+                bands_axis=-1,
+                processing_level=processing_level,
+                data_type=data_type,
+            )
+            with ThreadPoolExecutor(
+                max_workers=max(1, min(MAX_WORKERS, len(scenes_grouped)))
+            ) as executor:
+                mosaics = executor.map(mosaic, scenes_grouped)
+                img_stack = _fill_stack(
+                    (m[np.newaxis] for m in mosaics), len(scenes_grouped), want_mask
                 )
-                img_stack.append(img_stack_i)
 
         else:
-            for sidx in range(0, len(scenes), raster_len):
-                eidx = sidx + raster_len
-                img_stack_i = scenes[sidx:eidx].stack(
+            # raster chunks concurrently, map keeps them in order
+            chunks = [
+                scenes[sidx : sidx + raster_len]
+                for sidx in range(0, len(scenes), raster_len)
+            ]
+
+            def stack(ss):
+                return ss.stack(
                     bands=bands,
                     ctx=ctx,
                     scaling=scales,
@@ -242,13 +304,13 @@ def query_scenes(
                     processing_level=processing_level,
                     data_type=data_type,
                 )
-                for img in img_stack_i:
-                    img_stack.append(img)
 
-        if np.ma.is_masked(img_stack):
-            img_stack = np.ma.array(img_stack)
-        else:
-            img_stack = np.array(img_stack)
+            with ThreadPoolExecutor(
+                max_workers=max(1, min(MAX_WORKERS, len(chunks)))
+            ) as executor:
+                img_stack = _fill_stack(
+                    executor.map(stack, chunks), len(scenes), want_mask
+                )
     else:
         img_stack = scenes.stack(
             bands=bands,
@@ -259,29 +321,20 @@ def query_scenes(
             processing_level=processing_level,
             data_type=data_type,
         )
-
-    # grab grouped scenes
-    scenes_grouped = list()
-    if flatten:
-        for key, ss in scenes.groupby(*flatten):
-            scenes_grouped.append(ss)
-    else:
-        for ss in scenes:
-            scenes_grouped.append(ss)
+        if not want_mask:
+            img_stack = np.ma.getdata(img_stack)
 
     # valid fraction filtering
     if valid_fraction:
-        idxs_keep = list()
         num_pixels_per_img = img_stack.shape[1] * img_stack.shape[2]
 
-        for idx, img in enumerate(img_stack):
-            num_pixels_invalid = np.count_nonzero(img.mask[:, :, 0])
-            valid_ratio = 1.0 - float(num_pixels_invalid) / float(num_pixels_per_img)
-            if valid_ratio >= valid_fraction:
-                idxs_keep.append(idx)
+        # count invalid pixels of every frame in one reduction, on the first band
+        num_pixels_invalid = np.ma.count_masked(img_stack[..., 0:1], axis=(1, 2, 3))
+        valid_ratio = 1.0 - num_pixels_invalid / float(num_pixels_per_img)
+        idxs_keep = np.flatnonzero(valid_ratio >= valid_fraction)
 
         img_stack = img_stack[idxs_keep, :, :, :]
-        scenes_grouped = [scenes_grouped[idx] for idx in idxs_keep]
+        scenes_grouped = [scenes_grouped[idx] for idx in idxs_keep.tolist()]
     
     if "alpha" in bands:
         img_stack = img_stack[:, :, :, :-1]
@@ -326,23 +379,69 @@ def export_scenes(
     else:
         data_type = None
 
-    for ss in scenes:
-        if type(ss) == Scene:
-            dest = os.path.join(outdir, ss.properties.id + '.tif')
-            ss.download(bands=bands,
-                        ctx=ctx,
-                        dest=dest,
-                        processing_level=processing_level,
-                        scaling=scales,
-                        data_type=data_type)
-        elif type(ss) == SceneCollection:
-            dest = os.path.join(outdir, ss[-1].properties.id + '.tif')
-            ss.download_mosaic(bands=bands,
-                               ctx=ctx,
-                               dest=dest,
-                               processing_level=processing_level,
-                               scaling=scales,
-                               data_type=data_type)
-
-        if verbose:
-            print(datetime.datetime.now(), 'Wrote GeoTIFF {}'.format(dest))
+    download = partial(
+        _download_one,
+        ctx=ctx,
+        bands=bands,
+        scales=scales,
+        processing_level=processing_level,
+        data_type=data_type,
+        outdir=outdir,
+        verbose=verbose,
+    )
+
+    # downloads are I/O bound, so fetch several at once
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(download, scenes))
+
+
+def _download_scene(ss, ctx, bands, scales, processing_level, data_type, outdir):
+    """Download a single scene to GeoTIFF, returning the file written"""
+    dest = os.path.join(outdir, ss.properties.id + '.tif')
+    ss.download(bands=bands,
+                ctx=ctx,
+                dest=dest,
+                processing_level=processing_level,
+                scaling=scales,
+                data_type=data_type)
+    return dest
+
+
+def _download_collection(ss, ctx, bands, scales, processing_level, data_type, outdir):
+    """Download the mosaic of a scene collection to GeoTIFF, returning the file written"""
+    dest = os.path.join(outdir, ss[-1].properties.id + '.tif')
+    ss.download_mosaic(bands=bands,
+                       ctx=ctx,
+                       dest=dest,
+                       processing_level=processing_level,
+                       scaling=scales,
+                       data_type=data_type)
+    return dest
+
+
+@lru_cache(maxsize=None)
+def _downloaders():
+    """Map scene types to their GeoTIFF downloader, importing the client on first use"""
+    from descarteslabs.scenes.scene import Scene
+    from descarteslabs.scenes.scenecollection import SceneCollection
+
+    return {Scene: _download_scene, SceneCollection: _download_collection}
+
+
+def _download_one(ss, ctx, bands, scales, processing_level, data_type, outdir, verbose):
+    """Download a single scene, or mosaic of a scene collection, to GeoTIFF"""
+    downloaders = _downloaders()
+    downloader = downloaders.get(type(ss))
+    if downloader is None:
+        # subclasses miss the exact type lookup
+        for cls, func in downloaders.items():
+            if isinstance(ss, cls):
+                downloader = func
+                break
+        else:
+            return
+
+    dest = downloader(ss, ctx, bands, scales, processing_level, data_type, outdir)
+
+    if verbose:
+        print(datetime.datetime.now(), 'Wrote GeoTIFF {}'.format(dest), flush=True)
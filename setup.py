@@ -8,13 +8,23 @@ setup(
     entry_points={"console_scripts": ["dl-animate=animate:main"]},
     setup_requires=["setuptools>40"],
     install_requires=[
-        "descarteslabs[complete]>=0.24.0",
+        "descarteslabs>=0.24.0",
         "numpy>=1.16",
-        "scipy>=1.1.0",
         "matplotlib>=3.0.0",
-        "moviepy>=1.0.0",
-        "pyfftw>=0.11.0",
-        "scikit-image>=0.15.0",
         "Pillow>=2.2.2",
+        "orjson>=3.8",
     ],
+    extras_require={
+        "coregister": ["pyfftw>=0.11.0", "scipy>=1.1.0", "scikit-image>=0.17.0"],
+        "moviepy": ["moviepy>=1.0.0"],
+        "numba": ["numba>=0.45.0"],
+        "complete": [
+            "descarteslabs[complete]>=0.24.0",
+            "pyfftw>=0.11.0",
+            "scipy>=1.1.0",
+            "scikit-image>=0.17.0",
+            "moviepy>=1.0.0",
+            "numba>=0.45.0",
+        ],
+    },
 )